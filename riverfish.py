@@ -7,7 +7,7 @@
 * one thread doing multiple ops at once is bad too; for example, iterating and doing dels/adds during the iteration
 * keeping one client over the length of operations with a river object? this could be bad too..
 * if I am going to allow reindexing, river objects can't cache IND anymore.
-* transaction failure during index node creation can produce index node clutter if the transaction isn't retried until success
+* transaction failure during index node creation can produce index node clutter if the transaction isn't retried until success; Reaper verifies and tightens it
 * check that every added metadata has a KEY which is an int and probably has UUID, size, mime type, and encoding?
 * maybe move away from msgpack, it's not great for list/tuple differences
 * write a decorator that can work with either one-off or generator style functions and does locking on the client resource
@@ -17,7 +17,10 @@
 * check the correct exceptions are raised for every memcached false response
 """
 
+import re
+import time
 import uuid
+import bisect
 import msgpack
 from binascii import crc32
 
@@ -52,9 +55,18 @@ class ResultsNotUniqueException(SafelyFailedException, NoopException) :
 class DisallowedMetadataKeyException(SafelyFailedException, NoopException) :
 	"""Keys beginning with _ are not allowed in the metadata"""
 
+class DisallowedMetadataValueException(SafelyFailedException, NoopException) :
+	"""Values of metadata keys with a secondary index must be strings"""
+
+class InvalidRiverNameException(SafelyFailedException, NoopException) :
+	"""River names may not contain the secondary index separator"""
+
 class IterationOptionsException(SafelyFailedException, NoopException) :
 	"""Iteration options are not allowed."""
 
+class SecondaryIndexDoesNotExistException(SafelyFailedException, NoopException) :
+	"""The river has no secondary index on the requested metadata field."""
+
 # TODO determine if this qualifies as a NoopException
 class RiverDeletedException(SafelyFailedException) :
 	"""The River in use was deleted. The current operation failed."""
@@ -62,6 +74,11 @@ class RiverDeletedException(SafelyFailedException) :
 class ContentionFailureException(SafelyFailedException, PartialFailureException) :
 	"""The operation failed partially due to contention."""
 
+# secondary index rivers are named <river><separator><field>; user created rivers may not use the separator.
+secondary_separator = ':sec:'
+# secondary index fields end up in memcached keys, which can not hold whitespace.
+secondary_field_re = re.compile(r'^[^_\s]\S*$')
+
 class DefaultLevels :
 	SLOW_UPDATE_REAL_TIME = [10000000, 1000000, 100000, 10000]
 	CRC_OPTIMIZED = [430000000, 4300000, 43000, 430]
@@ -82,6 +99,17 @@ def singular_if_unique(f) :
 
 	return _inner
 
+def canonical(v) :
+	"""
+	canonical, hashable form of a metadata value; dicts become sorted item tuples and lists become tuples,
+	as msgpack hands lists back as tuples.
+	"""
+	if isinstance(v, dict) :
+		return tuple([(k, canonical(v[k])) for k in sorted(v.keys())])
+	elif isinstance(v, (list, tuple)) :
+		return tuple([canonical(i) for i in v])
+	return v
+
 def filter_key_on_one_arg(f) :
 	def _inner(self, arg) :
 		if self.key_transform :
@@ -110,7 +138,10 @@ class River(object) :
 
 	# TODO fail if ind, ktr, or unique is supplied in a forceful way (included on the command) and create is false and it conflicts
 	# TODO fail on unsupported key transform before adding anything to backing datastore
-	def __init__(self, client, name, create=False, key_transform=None, ind=DefaultLevels.DEFAULT, unique=False) :
+	def __init__(self, client, name, create=False, key_transform=None, ind=DefaultLevels.DEFAULT, unique=False, secondary=(), _secondary=False) :
+		if create and not _secondary and secondary_separator in name :
+			raise InvalidRiverNameException("river name '%s' may not contain '%s'" % (name, secondary_separator))
+
 		self.client = client
 		self.name = name
 		self.unique = unique
@@ -124,16 +155,35 @@ class River(object) :
 		if create :
 			self.ind = ind
 
+			for field in secondary :
+				if not secondary_field_re.match(field) :
+					raise DisallowedMetadataKeyException("metadata key '%s' disallowed" % field)
+
 			data = {
 				'IND' : self.ind,
 				'FIN' : None,
 				'LIN' : None,
 				'KTR' : key_transform,
-				'UNQ' : self.unique
+				'UNQ' : self.unique,
+				'SEC' : list(secondary)
 			}
-			if not self._apack(self.rnkey, data) :
+			if self._getRiverNode() :
 				raise RiverAlreadyExistsException("river %s already exists" % self.name)
 
+			# secondary indexes are auxiliary rivers keyed on the metadata field value, holding the primary key.
+			# they are created before the river node, and removed again if anything fails, so a failed create
+			# leaves no river attached to them.
+			self.secondary = {}
+			try :
+				for field in secondary :
+					self.secondary[field] = StringKeyedRiver(self.client, self._secondaryRiverName(field), create=True, _secondary=True)
+				if not self._apack(self.rnkey, data) :
+					raise RiverAlreadyExistsException("river %s already exists" % self.name)
+			except Exception :
+				for sriver in self.secondary.values() :
+					self.client.delete(sriver.rnkey)
+				raise
+
 		else :
 			data = self._getRiverNode()
 			if not data :
@@ -142,6 +192,10 @@ class River(object) :
 			self.unique = data['UNQ']
 			key_transform = data['KTR']
 
+			self.secondary = {}
+			for field in data.get('SEC', ()) :
+				self.secondary[field] = StringKeyedRiver(self.client, self._secondaryRiverName(field), _secondary=True)
+
 		if key_transform :
 			try :
 				self.key_transform = getattr(type(self), key_transform)
@@ -190,7 +244,12 @@ class River(object) :
 		"""
 		return self.client.cas(k, msgpack.packs(v))
 
-	# river nodes
+	def _gmupack(self, ks) :
+		"""
+		get_multi based unpack/lookup; returns a dict of only the keys that were found
+		"""
+		return dict([(k, self._unpack(v)) for k, v in self.client.get_multi(ks).items()])
+
 	def _getRiverNode(self) :
 		return self._gupack(self.rnkey)
 
@@ -211,13 +270,64 @@ class River(object) :
 		index_node = self._getsIndexNode(key, indl)
 		ikey = self._indexNodeName(key, indl)
 		if index_node :
-			index_node['FIN'] = min(key, index_node['FIN'])
+			# writing the node clears any Reaper mark on it; FIN/LIN are None if a Reaper emptied it.
+			index_node.pop('RAP', None)
+			index_node['FIN'] = minn(key, index_node['FIN'])
 			index_node['LIN'] = max(key, index_node['LIN'])
 			return self._cupack(ikey, index_node)
 		else :
 			return self._apack(ikey, {'FIN' : key, 'LIN' : key})
 
+	def _confirmIndexNode(self, key, indl) :
+		"""
+		makes sure the index node covers key and carries no Reaper mark, rewriting it if not.
+		"""
+		index_node = self._getIndexNode(key, indl)
+		if index_node and 'RAP' not in index_node and index_node['FIN'] is not None and index_node['FIN'] <= key <= index_node['LIN'] :
+			return True
+		return self._addIndexNode(key, indl)
+
+	def _confirmIndexNodes(self, key) :
+		"""
+		confirms every index node for key, from the bottom level up, so that a parent is only confirmed once
+		the nodes beneath it cover key.
+		"""
+		for indl_i in reversed(xrange(len(self.ind) - 1)) :
+			if not self._confirmIndexNode(key, self.ind[indl_i]) :
+				raise ContentionFailureException("could not confirm index node for key %d at level %d" % (key, self.ind[indl_i]))
+
+	# river nodes
+	def _updateRiverNode(self, key, river_node) :
+		"""
+		widens the river node read by gets to cover key, under cas.  It is written even if unchanged, so the
+		cas fails if a Reaper pass has marked the river node since it was read, even one that has ended since.
+		"""
+		if 'RAP' in river_node :
+			# keys added during a Reaper pass are kept apart, so the pass does not tighten them away at its end.
+			river_node['RFN'] = minn(river_node.get('RFN'), key)
+			river_node['RLN'] = max(river_node.get('RLN'), key)
+		river_node['FIN'] = minn(river_node['FIN'], key)
+		river_node['LIN'] = max(river_node['LIN'], key)
+		return self._cupack(self.rnkey, river_node)
+
+	# secondary index rivers
+	def _secondaryRiverName(self, field) :
+		return '%s%s%s' % (self.name, secondary_separator, field)
+
+	def _addSecondary(self, key, metadata) :
+		for field, sriver in self.secondary.items() :
+			if field in metadata :
+				sriver.add(metadata[field], {'KEY' : metadata[field], 'PKY' : key})
+
 	# list nodes (a type of index node)
+	# besides the metadata lists, list nodes keep ORD, the sorted list of their keys.  List nodes written
+	# before then have it built from their int keys.
+	@classmethod
+	def _listNodeOrder(cls, list_node) :
+		if 'ORD' in list_node :
+			return list_node['ORD']
+		return sorted([k for k in list_node if not isinstance(k, str)])
+
 	def _addMetaData(self, key, indl, metadata) :
 		likey = self._indexNodeName(key, indl)
 		list_node = self._getsIndexNode(key, indl)
@@ -234,15 +344,20 @@ class River(object) :
 					if meta_list :
 						# this key already has a non-empty list in this space. fail!
 						raise RiverKeyAlreadyExistsException("Key %d exists and the river has unique=True." % key)
-			if metadata in meta_list :
-				# retries won't know if it's in there yet. Just succeed if the exact metadata exists already.
+			# retries won't know if it's in there yet. Just succeed if the exact metadata exists already.
+			# compared by hashing canonical forms, as the stored metadata has been through msgpack.
+			if canonical(metadata) in set([canonical(m) for m in meta_list]) :
 				return True
+			order = list(River._listNodeOrder(list_node))
+			if not meta_list :
+				bisect.insort(order, key)
+			list_node['ORD'] = order
+			# every metadata in the list has the same KEY; keeping insertion order keeps it sorted.
 			meta_list.append(metadata)
-			meta_list.sort(cmp=lambda d1,d2: long.__cmp__(long(d1['KEY']), long(d2['KEY'])))
 			list_node[key] = meta_list
 			return self._cupack(likey, list_node)
 		else :
-			return self._apack(likey, {key : [metadata]})
+			return self._apack(likey, {key : [metadata], 'ORD' : [key]})
 
 	"""
 	Add a fish to the river, given the fish's metadata.
@@ -254,7 +369,14 @@ class River(object) :
 			if k.startswith('_') :
 				raise DisallowedMetadataKeyException("metadata key '%s' disallowed" % k)
 
+		for field in self.secondary :
+			if field in metadata and not isinstance(metadata[field], str) :
+				raise DisallowedMetadataValueException("metadata key '%s' has a secondary index, its value must be a string" % field)
+
+		# secondary indexes refer to fish by the key as given, before any transform.
+		pkey = key
 		if self.key_transform :
+			pkey = metadata['KEY']
 			metadata['_KEY'] = metadata['KEY']
 			metadata['KEY'] = self.key_transform(metadata['KEY'])
 			key = metadata['KEY']
@@ -264,6 +386,9 @@ class River(object) :
 		
 		if not river_node :
 			raise RiverDeletedException("Once the river flows to the sea, is it still a river?")
+
+		# secondary entries go in before the fish itself; an entry whose fish never lands is filtered out by by().
+		self._addSecondary(pkey, metadata)
 		
 		for indl_i in xrange(len(self.ind) - 1) :
 			if not self._addIndexNode(key, self.ind[indl_i]) :
@@ -272,24 +397,19 @@ class River(object) :
 		if not self._addMetaData(key, low_level, metadata) :
 			raise ContentionFailureException("could not add list node for key %d at level %d" % (key, low_level))
 
-		updated = False
-		if river_node['FIN'] is None :
-			river_node['FIN'] = key
-			updated = True
-		else :
-			if river_node['FIN'] != key :
-				river_node['FIN'] = min(river_node['FIN'], key)
-				updated = True
-		if river_node['LIN'] is None :
-			river_node['LIN'] = key
-			updated = True
-		else :
-			if river_node['LIN'] != key :
-				river_node['LIN'] = max(river_node['LIN'], key)
-				updated = True
+		# while a Reaper pass is marked on the river node, it may have marked or tightened the index nodes as
+		# the list node was written; see Reaper.
+		if 'RAP' in river_node :
+			self._confirmIndexNodes(key)
 
-		if updated and not self._cupack(self.rnkey, river_node) :
-			raise ContentionFailureException("could not update the river node for FIN/LIN update.")
+		if not self._updateRiverNode(key, river_node) :
+			# the river node changed during the add; perhaps a Reaper pass started, so confirm and try again.
+			river_node = self._getsRiverNode()
+			if not river_node :
+				raise RiverDeletedException("Once the river flows to the sea, is it still a river?")
+			self._confirmIndexNodes(key)
+			if not self._updateRiverNode(key, river_node) :
+				raise ContentionFailureException("could not update the river node for FIN/LIN update.")
 
 	@singular_if_unique
 	@filter_key_on_one_arg
@@ -311,6 +431,53 @@ class River(object) :
 		else :
 			return list(meta_data[key])
 
+	def by(self, field, value) :
+		"""
+		Looks up fish by the value of a metadata field that the river has a secondary index on.  The
+		secondary index is resolved first, then the list nodes of all the primary keys found are fetched
+		in one batch.  Always returns a list, even on a unique river, as many fish can share a field value.
+		"""
+		try :
+			sriver = self.secondary[field]
+		except KeyError :
+			raise SecondaryIndexDoesNotExistException("river %s has no secondary index on %s" % (self.name, field))
+
+		river_node = self._getRiverNode()
+		if not river_node :
+			raise RiverDeletedException("Once the river flows to the sea, is it still a river?")
+
+		pkeys = []
+		seen = set()
+		for m in sriver.get(value) :
+			if m['PKY'] not in seen :
+				seen.add(m['PKY'])
+				pkeys.append(m['PKY'])
+
+		low_level = self.ind[len(self.ind)-1]
+		tkeys = {}
+		for pkey in pkeys :
+			if self.key_transform :
+				tkeys[pkey] = self.key_transform(pkey)
+			else :
+				tkeys[pkey] = pkey
+		list_nodes = self._gmupack(list(set([self._indexNodeName(k, low_level) for k in tkeys.values()])))
+
+		r = []
+		for pkey in pkeys :
+			key = tkeys[pkey]
+			list_node = list_nodes.get(self._indexNodeName(key, low_level))
+			if not list_node or key not in list_node :
+				continue
+			for m in list_node[key] :
+				if m.get(field) != value :
+					continue
+				if self.key_transform :
+					if m['_KEY'] != pkey :
+						continue
+					m = River._untransform_key(m)
+				r.append(m)
+		return r
+
 	def lowerbound(self, key, key_transformed=False) :
 		"""
 		Creates an (inclusive) lower bound on the key for iteration.  If key_transformed is False and
@@ -348,9 +515,28 @@ class River(object) :
 	def __iter__(self) :
 		return Boat(self)
 
+	def explain(self) :
+		"""
+		Runs the iteration this river (or wave) describes and returns a Trace of what it cost at each level.
+		"""
+		trace = Trace(self.ind)
+		for r in Boat(self, trace=trace) :
+			pass
+		return trace
+
+	def estimate(self) :
+		"""
+		Predicts the cost of the iteration this river (or wave) describes from the index nodes alone; the list
+		node slots are counted but not fetched.  Returns a Trace.
+		"""
+		trace = Trace(self.ind)
+		for r in Boat(self, trace=trace, dry_run=True) :
+			pass
+		return trace
+
 class StringKeyedRiver(River) :
-	def __init__(self, client, name, create=False, ind=DefaultLevels.CRC_OPTIMIZED, unique=False) :
-		River.__init__(self, client, name, create=create, ind=ind, key_transform='kt_stringcrc', unique=unique)
+	def __init__(self, client, name, create=False, ind=DefaultLevels.CRC_OPTIMIZED, unique=False, secondary=(), _secondary=False) :
+		River.__init__(self, client, name, create=create, ind=ind, key_transform='kt_stringcrc', unique=unique, secondary=secondary, _secondary=_secondary)
 
 class Wave(River) :
 	def __init__(self, river, _iteration_options=None) :
@@ -372,23 +558,85 @@ def minn(a, b) :
 		return a
 	return min(a, b)
 
-def fits_border(l, v, u) :
-	if l is not None and v < l :
-		return False
-	elif u is not None and v > u :
-		return False
-	return True
+class Trace(object) :
+	"""
+	What a Boat did at each level of the river: slots enumerated, nodes fetched (gets issued), nodes missing
+	(gets that found nothing), bytes decoded and results yielded.  levels has one entry per level of the
+	river's ind; the river node fetch is counted separately in river_node.
+	"""
+	FIELDS = ('slots', 'fetched', 'missing', 'bytes', 'results')
+
+	def __init__(self, ind) :
+		self.ind = list(ind)
+		self.river_node = dict([(f, 0) for f in Trace.FIELDS])
+		self.levels = [dict([(f, 0) for f in Trace.FIELDS]) for indl in self.ind]
+
+	def total(self, field) :
+		return self.river_node[field] + sum([level[field] for level in self.levels])
+
+	@property
+	def predicted_fetches(self) :
+		"""
+		the number of gets the full iteration takes: the river node, then one per slot enumerated.
+		"""
+		return 1 + self.total('slots')
+
+	def __str__(self) :
+		rows = [('level',) + Trace.FIELDS, ('rn',) + tuple([self.river_node[f] for f in Trace.FIELDS])]
+		for indl, level in zip(self.ind, self.levels) :
+			rows.append((indl,) + tuple([level[f] for f in Trace.FIELDS]))
+		return '\n'.join([''.join(['%12s' % c for c in row]) for row in rows])
 
 class Boat(object) :
-	def __init__(self, river) :
+	def __init__(self, river, trace=None, dry_run=False) :
+		"""
+		If a Trace is given, the iteration is counted in it.  With dry_run, list nodes are not fetched and
+		nothing is yielded.
+		"""
 		self.river = river
+		self.trace = trace
+		self.dry_run = dry_run
 		self.iter = self.iterate()
 
+	def _fetch(self, k, level) :
+		"""
+		fetches and unpacks a node, counting it at the given trace level.
+		"""
+		v = self.river.client.get(k)
+		level['fetched'] += 1
+		if v is None :
+			level['missing'] += 1
+		else :
+			level['bytes'] += len(v)
+		return self.river._unpack(v)
+
+	def _getRiverNode(self) :
+		if not self.trace :
+			return self.river._getRiverNode()
+		return self._fetch(self.river.rnkey, self.trace.river_node)
+
+	def _getIndexNode(self, key, ind, iind) :
+		if not self.trace :
+			return self.river._getIndexNode(key, ind[iind])
+		return self._fetch(self.river._indexNodeName(key, ind[iind]), self.trace.levels[iind])
+
+	def _enumerated(self, sub, iind) :
+		if self.trace :
+			self.trace.levels[iind]['slots'] += len(sub)
+		return sub
+
 	def iterate(self) :
 		reverse = self.river.iteration_options['REV']
 		lower = self.river.iteration_options['LWR']
 		upper = self.river.iteration_options['UPR']
 
+		if self.river.key_transform :
+			metadata_filter_function = River._untransform_key
+			key_filter_function = lambda k, m: m['KEY']
+		else :
+			metadata_filter_function = lambda m: m
+			key_filter_function = lambda k, m: k
+
 		OP_GET_RN = 0
 		OP_GET_IN = 1
 		OP_GET_LN = 2
@@ -398,8 +646,10 @@ class Boat(object) :
 		while stack :
 			op, arg = stack.pop()
 			if op == OP_GET_RN :
-				rn = self.river._getRiverNode()
+				rn = self._getRiverNode()
 				ind = rn['IND']
+				if rn['FIN'] is None :
+					continue
 				fin = max(lower, rn['FIN'])
 				lin = minn(upper, rn['LIN'])
 
@@ -411,13 +661,13 @@ class Boat(object) :
 						sub = range(fks, lks+1, ind[iind])
 					else :
 						sub = xrange(lks, fks-1, -ind[iind])
-					for key in sub :
+					for key in self._enumerated(sub, iind) :
 						# reverse the order of top level index lookups, add to the stack (start low)
 						stack.append((OP_GET_IN, (key, 0)))
 			elif op == OP_GET_IN :
 				key, iind = arg
-				index_node = self.river._getIndexNode(key, ind[iind])
-				if not index_node :
+				index_node = self._getIndexNode(key, ind, iind)
+				if not index_node or index_node['FIN'] is None :
 					continue
 				fin = max(lower, index_node['FIN'])
 				lin = minn(upper, index_node['LIN'])
@@ -435,30 +685,266 @@ class Boat(object) :
 						sub = range(fks, lks+1, ind[next_iind])
 					else :
 						sub = xrange(lks, fks-1, -ind[next_iind])
-					for key in sub :
+					for key in self._enumerated(sub, next_iind) :
 						stack.append((next_op, (key, next_iind)))
 			elif op == OP_GET_LN :
 				key, iind = arg
-				list_node = self.river._getIndexNode(key, ind[iind])
+				if self.dry_run :
+					continue
+				list_node = self._getIndexNode(key, ind, iind)
 				if not list_node :
 					continue
-				list_keys = list_node.keys()
-				list_keys.sort(reverse=reverse)
-
-				if self.river.key_transform :
-					metadata_filter_function = River._untransform_key
-					key_filter_function = lambda k, m: m['KEY']
-				else :
-					metadata_filter_function = lambda m: m
-					key_filter_function = lambda k, m: k
+				# ORD is already sorted; cut it down to the bounds instead of checking each key.
+				list_keys = River._listNodeOrder(list_node)
+				lk_lower = 0
+				lk_upper = len(list_keys)
+				if lower is not None :
+					lk_lower = bisect.bisect_left(list_keys, lower)
+				if upper is not None :
+					lk_upper = bisect.bisect_right(list_keys, upper)
+				list_keys = list_keys[lk_lower:lk_upper]
+				if reverse :
+					list_keys = reversed(list_keys)
 
 				for key in list_keys :
-					lv = [metadata_filter_function(m) for m in list_node[key]]
+					lv = list_node[key]
 					if reverse :
-						lv.reverse()
-					for value in lv :
-						if fits_border(lower, key, upper) :
-							yield key_filter_function(key, value), value
+						lv = reversed(lv)
+					for m in lv :
+						value = metadata_filter_function(m)
+						if self.trace :
+							self.trace.levels[iind]['results'] += 1
+						yield key_filter_function(key, value), value
+
+	def __iter__(self) :
+		return self
 
 	def next(self) :
 		return self.iter.next()
+
+class Reaper(object) :
+	"""
+	Verifies a river's index nodes and optionally repairs them.  Failed or unretried adds can leave index
+	nodes whose FIN/LIN range is wider than the data beneath them (over-wide) or that have no data beneath
+	them at all (orphaned); every later Boat probes their slots for nothing.  The river is walked depth first
+	in batches of at most batch_size node fetches, sleeping pause seconds between batches.  The cursor holds
+	the walk, so a pass can be stopped after any batch and resumed by passing the cursor to a new Reaper.
+
+	With repair=True, over-wide nodes are tightened and orphaned nodes emptied (FIN/LIN set to None) under
+	CAS; nodes that are fine are not written.  Nodes are not deleted, as a delete can not be guarded by CAS.
+	To run alongside live writers, the pass marks the river node (RAP) when it starts, and an index node
+	is marked before the children it is tightened to are read, then only rewritten if its mark is still
+	intact.  An add that finds the river node marked (or that loses its cas on the river node) confirms its
+	index nodes from the bottom level up once its list node is written, rewriting any that is marked or no
+	longer covers its key.  So either a node's children are read after they cover the add's key, or the add
+	widens the node again afterwards.  Adds during the pass also keep the range of their keys in the river
+	node (RFN/RLN), which the pass includes when it tightens the river node at its end.
+	The Reaper's river needs a client of its own, as cas tokens are kept per client.
+
+	With repair=False nothing is written, and nodes being written to at the time may be reported.
+	"""
+	def __init__(self, river, batch_size=500, pause=0.5, repair=True, cursor=None) :
+		self.river = river
+		self.batch_size = batch_size
+		self.pause = pause
+		self.repair = repair
+		self.cursor = cursor
+		self.fetches = 0
+		self.report = {
+			'slots' : 0,
+			'nodes' : 0,
+			'fetches' : 0,
+			'overwide' : [],
+			'orphaned' : [],
+			'tightened' : 0,
+			'emptied' : 0,
+			'contended' : 0
+		}
+
+	def _get(self, key, iind) :
+		self.fetches += 1
+		self.report['fetches'] += 1
+		return self.river._getIndexNode(key, self.river.ind[iind])
+
+	def _gets(self, key, iind) :
+		self.fetches += 1
+		self.report['fetches'] += 1
+		return self.river._getsIndexNode(key, self.river.ind[iind])
+
+	def _frame(self, iind, key, fin, lin) :
+		"""
+		a node on the walk's stack: its range, the next child slot to visit and the extents found beneath it
+		so far.  The river node is level -1.
+		"""
+		step = self.river.ind[iind + 1]
+		return {'IND' : iind, 'KEY' : key, 'FIN' : fin, 'LIN' : lin, 'NXT' : fin - (fin % step), 'EFN' : None, 'ELN' : None}
+
+	def _start(self) :
+		"""
+		starts a pass: marks the river node and puts it on the walk's stack.
+		"""
+		river = self.river
+		rn = river._getsRiverNode()
+		if not rn :
+			raise RiverDeletedException("Once the river flows to the sea, is it still a river?")
+
+		cursor = {'TOK' : uuid.uuid4().hex, 'STK' : []}
+		if rn['FIN'] is not None :
+			if self.repair :
+				rn['RAP'] = cursor['TOK']
+				rn['RFN'] = None
+				rn['RLN'] = None
+				if not river._cupack(river.rnkey, rn) :
+					raise ContentionFailureException("could not mark the river node to start a pass.")
+			cursor['STK'].append(self._frame(-1, None, rn['FIN'], rn['LIN']))
+		self.cursor = cursor
+
+	def _finish(self, fin, lin) :
+		"""
+		ends a pass: tightens the river node to the extents found and the keys added during the pass.
+		"""
+		river = self.river
+		while True :
+			rn = river._getsRiverNode()
+			if not rn :
+				raise RiverDeletedException("Once the river flows to the sea, is it still a river?")
+			old = (rn['FIN'], rn['LIN'])
+			if not self.repair :
+				new = (fin, lin)
+				break
+			if rn.get('RAP') != self.cursor['TOK'] :
+				# another pass has marked the river node since; it is left to that pass.
+				self.report['contended'] += 1
+				return
+			new = (minn(fin, rn['RFN']), max(lin, rn['RLN']))
+			for k in ('RAP', 'RFN', 'RLN') :
+				del rn[k]
+			rn['FIN'], rn['LIN'] = new
+			if river._cupack(river.rnkey, rn) :
+				break
+
+		if new != old :
+			self.report['overwide'].append((river.rnkey, old, new))
+			if self.repair and new[0] is None :
+				self.report['emptied'] += 1
+			elif self.repair :
+				self.report['tightened'] += 1
+
+	def _extents(self, key, iind) :
+		"""
+		the range the node at key and level claims: FIN/LIN for index nodes, the first and last key for list
+		nodes.  (None, None) if there is no node or it is empty.
+		"""
+		node = self._get(key, iind)
+		if not node :
+			return None, None
+		if iind == len(self.river.ind) - 1 :
+			order = River._listNodeOrder(node)
+			return order[0], order[-1]
+		return node['FIN'], node['LIN']
+
+	def _tighten(self, key, iind) :
+		"""
+		marks the index node at key and level, then tightens it to the extents its children claim.  Returns
+		the node's range afterwards.
+		"""
+		river = self.river
+		name = river._indexNodeName(key, river.ind[iind])
+
+		node = self._gets(key, iind)
+		if not node or node['FIN'] is None :
+			return None, None
+		node['RAP'] = self.cursor['TOK']
+		if not river._cupack(name, node) :
+			self.report['contended'] += 1
+			return self._extents(key, iind)
+
+		# the children are read after the mark; an add writing beneath the node since clears the mark.
+		fin, lin = None, None
+		step = river.ind[iind + 1]
+		for ckey in xrange(node['FIN'] - (node['FIN'] % step), node['LIN'] + 1, step) :
+			cfin, clin = self._extents(ckey, iind + 1)
+			if cfin is not None :
+				fin = minn(fin, cfin)
+				lin = max(lin, clin)
+
+		node = self._gets(key, iind)
+		if not node or node.get('RAP') != self.cursor['TOK'] :
+			self.report['contended'] += 1
+			return self._extents(key, iind)
+		if not river._cupack(name, {'FIN' : fin, 'LIN' : lin}) :
+			self.report['contended'] += 1
+			return self._extents(key, iind)
+
+		if (fin, lin) != (node['FIN'], node['LIN']) :
+			if fin is None :
+				self.report['emptied'] += 1
+			else :
+				self.report['tightened'] += 1
+		return fin, lin
+
+	def _step(self) :
+		"""
+		one step of the walk: visits the next child slot of the node on top of the stack, or, once they have
+		all been visited, finishes that node and passes its extents up.
+		"""
+		river = self.river
+		stack = self.cursor['STK']
+		frame = stack[-1]
+		iind = frame['IND']
+
+		if frame['NXT'] > frame['LIN'] :
+			stack.pop()
+			fin, lin = frame['EFN'], frame['ELN']
+			if iind < 0 :
+				self._finish(fin, lin)
+				return
+			if (fin, lin) != (frame['FIN'], frame['LIN']) :
+				name = river._indexNodeName(frame['KEY'], river.ind[iind])
+				if fin is None :
+					self.report['orphaned'].append(name)
+				else :
+					self.report['overwide'].append((name, (frame['FIN'], frame['LIN']), (fin, lin)))
+				if self.repair :
+					fin, lin = self._tighten(frame['KEY'], iind)
+			parent = stack[-1]
+		else :
+			key = frame['NXT']
+			frame['NXT'] += river.ind[iind + 1]
+			if iind < 0 :
+				self.report['slots'] += 1
+			if iind + 1 < len(river.ind) - 1 :
+				node = self._get(key, iind + 1)
+				if node :
+					self.report['nodes'] += 1
+					if node['FIN'] is not None :
+						stack.append(self._frame(iind + 1, key, node['FIN'], node['LIN']))
+				return
+			fin, lin = self._extents(key, iind + 1)
+			if fin is not None :
+				self.report['nodes'] += 1
+			parent = frame
+
+		if fin is not None :
+			parent['EFN'] = minn(parent['EFN'], fin)
+			parent['ELN'] = max(parent['ELN'], lin)
+
+	def batch(self) :
+		"""
+		Walks one batch of at most batch_size node fetches (a repair can go over by one node's children).
+		Returns False once the pass is complete.
+		"""
+		if self.cursor is None :
+			self._start()
+		self.fetches = 0
+		while self.cursor['STK'] and self.fetches < self.batch_size :
+			self._step()
+		return bool(self.cursor['STK'])
+
+	def run(self) :
+		"""
+		Walks the rest of the pass, pausing between batches.  Returns the report.
+		"""
+		while self.batch() :
+			time.sleep(self.pause)
+		return self.report
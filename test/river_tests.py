@@ -78,6 +78,11 @@ class RiverfishTests(unittest.TestCase) :
 		river.add(k, d2)
 		self.assertEquals([d, d2], river.get(k))
 
+	def _reaperRiver(self) :
+		# the reaper runs alongside the writer, so it needs a client (and cas tokens) of its own.
+		client = memcache_exceptional.Client(['127.0.0.1:11211'], immortal=True, pickleProtocol=True)
+		return riverfish.River(client, self.rivername)
+
 	def _assertIterEquals(self, riv, exp) :
 		ind = 0
 		for i in riv :
@@ -281,3 +286,284 @@ class RiverfishTests(unittest.TestCase) :
 		river.add('a', {'KEY' : 'a', 'DATA' : 'test'})
 		river.add('b', {'KEY' : 'b', 'DATA' : 'test2'})
 		self.assertEquals(river.get('a'), {'KEY' : 'a', 'DATA' : 'test'})
+
+	def test_secondary_by(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, secondary=['MIME'])
+		d1 = {'KEY' : 1, 'MIME' : 'text/plain'}
+		d2 = {'KEY' : 2, 'MIME' : 'image/png'}
+		d3 = {'KEY' : 3 + riverfish.DefaultLevels.DEFAULT[0], 'MIME' : 'text/plain'}
+		river.add(1, d1)
+		river.add(2, d2)
+		river.add(d3['KEY'], d3)
+		self.assertEquals([d1, d3], river.by('MIME', 'text/plain'))
+		self.assertEquals([d2], river.by('MIME', 'image/png'))
+		self.assertEquals([], river.by('MIME', 'audio/ogg'))
+
+	def test_secondary_by_same_key(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, secondary=['MIME'])
+		d1 = {'KEY' : 1, 'MIME' : 'text/plain'}
+		d2 = {'KEY' : 1, 'MIME' : 'image/png'}
+		river.add(1, d1)
+		river.add(1, d2)
+		self.assertEquals([d2], river.by('MIME', 'image/png'))
+
+	def test_secondary_by_discovered(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, secondary=['MIME'])
+		d1 = {'KEY' : 1, 'MIME' : 'text/plain'}
+		river.add(1, d1)
+		findriver = riverfish.River(self.client, self.rivername)
+		self.assertEquals([d1], findriver.by('MIME', 'text/plain'))
+
+	def test_secondary_by_key_transform(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, ind=riverfish.DefaultLevels.CRC_OPTIMIZED, key_transform='kt_allzero', secondary=['HASH'])
+		river.add('a', {'KEY' : 'a', 'HASH' : 'abc'})
+		river.add('b', {'KEY' : 'b', 'HASH' : 'def'})
+		self.assertEquals([{'KEY' : 'b', 'HASH' : 'def'}], river.by('HASH', 'def'))
+
+	def test_secondary_leftover_create_fails_cleanly(self) :
+		leftover = riverfish.StringKeyedRiver(self.client, self.rivername + ':sec:HASH', create=True, _secondary=True)
+		try :
+			riverfish.River(self.client, self.rivername, create=True, secondary=['MIME', 'HASH'])
+			self.fail("should have failed on the leftover secondary river")
+		except riverfish.RiverAlreadyExistsException :
+			pass
+		try :
+			riverfish.River(self.client, self.rivername)
+			self.fail("the river should not have been created")
+		except riverfish.RiverDoesNotExistException :
+			pass
+		self.client.delete(leftover.rnkey)
+		river = riverfish.River(self.client, self.rivername, create=True, secondary=['MIME', 'HASH'])
+
+	def test_secondary_nonstring_value_fails(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, secondary=['SIZE'])
+		try :
+			river.add(1, {'KEY' : 1, 'SIZE' : 10})
+			self.fail("should have failed with a non-string value in an indexed field")
+		except riverfish.DisallowedMetadataValueException :
+			pass
+		self.assertEquals([], river.get(1))
+
+	def test_invalid_name_fails(self) :
+		try :
+			riverfish.River(self.client, self.rivername + ':sec:MIME', create=True)
+			self.fail("should have failed with the secondary separator in the river name")
+		except riverfish.InvalidRiverNameException :
+			pass
+		river = riverfish.River(self.client, self.rivername + ':MIME', create=True)
+		findriver = riverfish.River(self.client, self.rivername + ':MIME')
+
+	def test_secondary_by_unique_is_list(self) :
+		river = riverfish.River(self.client, self.rivername, create=True, unique=True, secondary=['MIME'])
+		d1 = {'KEY' : 1, 'MIME' : 'text/plain'}
+		d2 = {'KEY' : 2, 'MIME' : 'text/plain'}
+		river.add(1, d1)
+		river.add(2, d2)
+		self.assertEquals([d1, d2], river.by('MIME', 'text/plain'))
+		self.assertEquals(d1, river.get(1))
+
+	def test_secondary_by_unindexed_fails(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		try :
+			river.by('MIME', 'text/plain')
+			self.fail("should have failed without a secondary index on MIME")
+		except riverfish.SecondaryIndexDoesNotExistException :
+			pass
+
+	def test_reaper_tightens_overwide(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river.add(5000000, {'KEY' : 5000000, 'test' : 'test2'})
+		# clutter from an add that failed after its first index node
+		river._addIndexNode(7500000, top)
+		report = riverfish.Reaper(river, pause=0).run()
+		self.assertEquals([(river._indexNodeName(3, top), (3, 7500000), (3, 5000000))], report['overwide'])
+		self.assertEquals(1, report['tightened'])
+		self.assertEquals({'FIN' : 3, 'LIN' : 5000000}, river._getIndexNode(3, top))
+		self._assertIterEquals(river, [(3, {'KEY' : 3, 'test' : 'test1'}), (5000000, {'KEY' : 5000000, 'test' : 'test2'})])
+
+	def test_reaper_empties_orphaned(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		kbig = 3 * top + 1
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river._addIndexNode(kbig, top)
+		rn = river._getsRiverNode()
+		rn['LIN'] = kbig
+		river._cupack(river.rnkey, rn)
+		report = riverfish.Reaper(river, batch_size=1, pause=0).run()
+		self.assertEquals([river._indexNodeName(kbig, top)], report['orphaned'])
+		self.assertEquals([(river.rnkey, (3, kbig), (3, 3))], report['overwide'])
+		self.assertEquals(4, report['slots'])
+		self.assertEquals(3, river._getRiverNode()['LIN'])
+		self._assertIterEquals(river, [(3, {'KEY' : 3, 'test' : 'test1'})])
+		river.add(kbig, {'KEY' : kbig, 'test' : 'test2'})
+		self._assertIterEquals(river, [(3, {'KEY' : 3, 'test' : 'test1'}), (kbig, {'KEY' : kbig, 'test' : 'test2'})])
+
+	def test_reaper_verify_only_resumed(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river.add(top + 3, {'KEY' : top + 3, 'test' : 'test2'})
+		river._addIndexNode(top + 7500000, top)
+		reaper = riverfish.Reaper(river, batch_size=2, repair=False)
+		self.assertTrue(reaper.batch())
+		self.assertEquals(2, reaper.fetches)
+		self.assertEquals([], reaper.report['overwide'])
+		resumed = riverfish.Reaper(river, repair=False, cursor=reaper.cursor)
+		self.assertFalse(resumed.batch())
+		self.assertEquals([(river._indexNodeName(top, top), (top + 3, top + 7500000), (top + 3, top + 3))], resumed.report['overwide'])
+		self.assertEquals(top + 7500000, river._getIndexNode(top, top)['LIN'])
+
+	def test_reaper_batches_bounded_by_fetches(self) :
+		river = riverfish.StringKeyedRiver(self.client, self.rivername, create=True)
+		for i in xrange(50) :
+			river.add('key%d' % i, {'KEY' : 'key%d' % i})
+		reaper = riverfish.Reaper(river, batch_size=10, repair=False)
+		batches = 1
+		while reaper.batch() :
+			self.assertEquals(10, reaper.fetches)
+			batches += 1
+		self.assertTrue(batches > 10)
+		self.assertEquals([], reaper.report['overwide'])
+		self.assertEquals([], reaper.report['orphaned'])
+
+	def test_reaper_pass_during_add(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		d1 = {'KEY' : 3, 'test' : 'test1'}
+		d2 = {'KEY' : 50000, 'test' : 'test2'}
+		d3 = {'KEY' : top + 3, 'test' : 'test3'}
+		river.add(3, d1)
+		river.add(top + 3, d3)
+		reapers = []
+		add_meta_data = river._addMetaData
+		def interleaved(key, indl, metadata) :
+			# the add has written its index nodes; a whole pass tightens them before the list node is written.
+			reapers.append(riverfish.Reaper(self._reaperRiver(), pause=0))
+			reapers[0].run()
+			return add_meta_data(key, indl, metadata)
+		river._addMetaData = interleaved
+		river.add(50000, d2)
+		del river._addMetaData
+		self.assertEquals(3, reapers[0].report['tightened'])
+		self.assertEquals([d2], river.get(50000))
+		self._assertIterEquals(river, [(3, d1), (50000, d2), (top + 3, d3)])
+		report = riverfish.Reaper(river, repair=False).run()
+		self.assertEquals([], report['overwide'])
+		self.assertEquals([], report['orphaned'])
+
+	def test_reaper_parent_tightened_after_add_confirms(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		d1 = {'KEY' : 3, 'test' : 'test1'}
+		d2 = {'KEY' : 5000000, 'test' : 'test2'}
+		river.add(3, d1)
+		reaper = riverfish.Reaper(self._reaperRiver(), pause=0)
+		reaper._start()
+		stack = reaper.cursor['STK']
+		add_meta_data = river._addMetaData
+		def before_list_node(key, indl, metadata) :
+			# the reaper walks all of the top index node's children (emptying those for the new key), but does
+			# not finish the top index node yet.
+			while not (len(stack) == 2 and stack[-1]['NXT'] > stack[-1]['LIN']) :
+				reaper._step()
+			return add_meta_data(key, indl, metadata)
+		confirm_index_node = river._confirmIndexNode
+		def after_confirm(key, indl) :
+			# the reaper finishes the top index node as soon as the add has confirmed it.
+			r = confirm_index_node(key, indl)
+			if indl == top :
+				while len(stack) > 1 :
+					reaper._step()
+			return r
+		river._addMetaData = before_list_node
+		river._confirmIndexNode = after_confirm
+		river.add(5000000, d2)
+		del river._addMetaData
+		del river._confirmIndexNode
+		reaper.run()
+		self.assertEquals(2, reaper.report['emptied'])
+		self._assertIterEquals(river, [(3, d1), (5000000, d2)])
+
+	def test_reaper_leaves_clean_nodes_alone(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		top = riverfish.DefaultLevels.DEFAULT[0]
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river.add(5000000, {'KEY' : 5000000, 'test' : 'test2'})
+		node = river._getsIndexNode(3, top)
+		report = riverfish.Reaper(river, pause=0).run()
+		self.assertEquals(0, report['tightened'] + report['emptied'] + report['contended'])
+		# a writer between its gets and cas is not disturbed by the pass
+		self.assertTrue(river._cupack(river._indexNodeName(3, top), node))
+
+	def test_add_retry_no_duplicate(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		d = {'KEY' : 3, 'tags' : ['a', 'b'], 'nested' : {'b' : [1, 2], 'a' : 'x'}}
+		river.add(3, d)
+		river.add(3, d)
+		self.assertEquals(1, len(river.get(3)))
+
+	def test_list_node_without_ord(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		low = riverfish.DefaultLevels.DEFAULT[-1]
+		river.add(5, {'KEY' : 5, 'test' : 'test1'})
+		# a list node as written before ORD was kept
+		river.client.set(river._indexNodeName(5, low), riverfish.msgpack.packs({5 : [{'KEY' : 5, 'test' : 'test1'}], 3 : [{'KEY' : 3, 'test' : 'test2'}]}))
+		rn = river._getsRiverNode()
+		rn['FIN'] = 3
+		river._cupack(river.rnkey, rn)
+		river.add(3, {'KEY' : 3, 'test' : 'test2'})
+		river.add(4, {'KEY' : 4, 'test' : 'test3'})
+		self._assertIterEquals(river, [(3, {'KEY' : 3, 'test' : 'test2'}), (4, {'KEY' : 4, 'test' : 'test3'}), (5, {'KEY' : 5, 'test' : 'test1'})])
+
+	def test_iteration_one_list_node_bounded(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		keys = random.sample(xrange(riverfish.DefaultLevels.DEFAULT[-1]), 50)
+		for k in keys :
+			river.add(k, {'KEY' : k})
+		keys.sort()
+		exp = [(k, {'KEY' : k}) for k in keys[10:40]]
+		self._assertIterEquals(river.lowerbound(keys[10]).upperbound(keys[39]), exp)
+		exp.reverse()
+		self._assertIterEquals(river.lowerbound(keys[10]).upperbound(keys[39]).reverse, exp)
+
+	def test_explain(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		levels = riverfish.DefaultLevels.DEFAULT
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river.add(3, {'KEY' : 3, 'test' : 'test2'})
+		river.add(2 * levels[-1] + 3, {'KEY' : 2 * levels[-1] + 3, 'test' : 'test3'})
+		trace = river.explain()
+		self.assertEquals(1, trace.river_node['fetched'])
+		self.assertEquals([1, 1, 1, 3], [level['slots'] for level in trace.levels])
+		self.assertEquals([1, 1, 1, 3], [level['fetched'] for level in trace.levels])
+		self.assertEquals([0, 0, 0, 1], [level['missing'] for level in trace.levels])
+		self.assertEquals(3, trace.levels[-1]['results'])
+		self.assertTrue(trace.levels[-1]['bytes'] > 0)
+		self.assertEquals(7, trace.predicted_fetches)
+		self.assertEquals(trace.predicted_fetches, trace.total('fetched'))
+
+	def test_estimate(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		levels = riverfish.DefaultLevels.DEFAULT
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		river.add(2 * levels[-1] + 3, {'KEY' : 2 * levels[-1] + 3, 'test' : 'test3'})
+		trace = river.lowerbound(levels[-1]).estimate()
+		self.assertEquals([1, 1, 1, 2], [level['slots'] for level in trace.levels])
+		self.assertEquals([1, 1, 1, 0], [level['fetched'] for level in trace.levels])
+		self.assertEquals(0, trace.total('results'))
+		self.assertEquals(6, trace.predicted_fetches)
+
+	def test_iteration_uses_river_accessors(self) :
+		river = riverfish.River(self.client, self.rivername, create=True)
+		river.add(3, {'KEY' : 3, 'test' : 'test1'})
+		calls = []
+		get_index_node = river._getIndexNode
+		def counted(key, indl) :
+			calls.append(indl)
+			return get_index_node(key, indl)
+		river._getIndexNode = counted
+		self._assertIterEquals(river, [(3, {'KEY' : 3, 'test' : 'test1'})])
+		self.assertEquals(riverfish.DefaultLevels.DEFAULT, calls)